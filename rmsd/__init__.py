@@ -6,8 +6,10 @@ from .calc_rmsd_pythonbindings import *
 __all__ = [
     "str_atom",
     "int_atom",
+    "atom_weights",
     "rmsd",
     "kabsch_rmsd",
+    "kabsch_rmsd_only",
     "kabsch_rotate",
     "kabsch_fit",
     "kabsch",
@@ -41,6 +43,7 @@ __all__ = [
     "get_coordinates_xyz",
     "main",
     "get_rmsd",
+    "get_rmsd_batch",
 ]
 
 if __name__ == "__main__":
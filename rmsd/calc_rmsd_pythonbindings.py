@@ -1,43 +1,263 @@
-import argparse, copy, gzip, re, sys
-from pathlib import Path
-from typing import Any, Iterator, List, Optional, Protocol, Set, Tuple, Union
+import sys
+import warnings
+from typing import Any, Optional, Tuple
 from rmsd import * 
+from rmsd.calculate_rmsd import _squared_distances
 import numpy as np
 from numpy import ndarray
-from scipy.optimize import linear_sum_assignment  # type: ignore
-from scipy.spatial import distance_matrix  # type: ignore
-from scipy.spatial.distance import cdist  # type: ignore
 
 try:
-    import qml  # type: ignore
+    import numba  # type: ignore
 except ImportError:  # pragma: no cover
-    qml = None  # pragma: no cover
+    numba = None  # pragma: no cover
 
-def get_rmsd(p_all_atoms, p_all, q_all_atoms, q_all, reorder = True,
-             reorder_method = 'hungarian', rotation_method = 'kabsch',
-             use_reflections = False, use_ref_stereo = False,
-             print_rmsd = True) -> float:
+_ROT = {
+    METHOD_KABSCH: kabsch_rmsd,
+    METHOD_QUATERNION: quaternion_rmsd,
+    METHOD_NOROTATION: rmsd,
+}
+
+_REORDER = {
+    REORDER_QML: reorder_similarity,
+    REORDER_HUNGARIAN: reorder_hungarian,
+    REORDER_INERTIA_HUNGARIAN: reorder_inertia_hungarian,
+    REORDER_BRUTE: reorder_brute,
+    REORDER_DISTANCE: reorder_distance,
+}
 
+
+def _center_inplace(X: ndarray) -> ndarray:
     """
+    Translate the (N,3) coordinates X to their centroid, in place.
 
-    p/q_all_atoms -> list of atomic numbers
-    p/q_all -> np.ndarray of coordinates (N,3)
+    Returns
+    -------
+    C : ndarray
+        centroid of X before translation
+    """
+    C: ndarray = X.mean(axis=0)
+    X -= C
+    return C
+
+
+if numba is not None:
+
+    @numba.njit(cache=True, fastmath=True)
+    def _center_inplace(X: ndarray) -> ndarray:  # noqa: F811
+        # Both passes run row by row, so the second one reads X from cache
+        n = X.shape[0]
+        sx = 0.0
+        sy = 0.0
+        sz = 0.0
+        for i in range(n):
+            sx += X[i, 0]
+            sy += X[i, 1]
+            sz += X[i, 2]
+
+        cx = sx / n
+        cy = sy / n
+        cz = sz / n
+        for i in range(n):
+            X[i, 0] -= cx
+            X[i, 1] -= cy
+            X[i, 2] -= cz
+
+        return np.array([cx, cy, cz])
+
+    @numba.njit(cache=True)
+    def _kabsch_rmsd_kernel(P: ndarray, Q: ndarray) -> float:
+        n = P.shape[0]
+
+        # Centroids
+        p_cent = np.zeros(3)
+        q_cent = np.zeros(3)
+        for i in range(n):
+            for j in range(3):
+                p_cent[j] += P[i, j]
+                q_cent[j] += Q[i, j]
+        p_cent /= n
+        q_cent /= n
+
+        # Covariance matrix and inner products of the centered coordinates
+        H = np.zeros((3, 3))
+        e0 = 0.0
+        for i in range(n):
+            for j in range(3):
+                p_ij = P[i, j] - p_cent[j]
+                e0 += p_ij * p_ij
+                for k in range(3):
+                    H[j, k] += p_ij * (Q[i, k] - q_cent[k])
+                q_ij = Q[i, j] - q_cent[j]
+                e0 += q_ij * q_ij
+        e0 *= 0.5
+
+        # A single atom or coincident points
+        if e0 == 0.0:
+            return 0.0
+
+        # Instead of a general SVD, use the quaternion characteristic
+        # polynomial (QCP) of the 3x3 problem, doi:10.1002/jcc.21439.
+        # The RMSD only needs its largest eigenvalue, found by Newton's method.
+        sxx, sxy, sxz = H[0, 0], H[0, 1], H[0, 2]
+        syx, syy, syz = H[1, 0], H[1, 1], H[1, 2]
+        szx, szy, szz = H[2, 0], H[2, 1], H[2, 2]
+
+        sxx2 = sxx * sxx
+        syy2 = syy * syy
+        szz2 = szz * szz
+        sxy2 = sxy * sxy
+        syz2 = syz * syz
+        sxz2 = sxz * sxz
+        syx2 = syx * syx
+        szy2 = szy * szy
+        szx2 = szx * szx
+
+        syzszymsyyszz2 = 2.0 * (syz * szy - syy * szz)
+        sxx2syy2szz2syz2szy2 = syy2 + szz2 - sxx2 + syz2 + szy2
+
+        c2 = -2.0 * (sxx2 + syy2 + szz2 + sxy2 + syx2 + sxz2 + szx2 + syz2 + szy2)
+        c1 = 8.0 * (
+            sxx * syz * szy
+            + syy * szx * sxz
+            + szz * sxy * syx
+            - sxx * syy * szz
+            - syz * szx * sxy
+            - szy * syx * sxz
+        )
+
+        sxzpszx = sxz + szx
+        syzpszy = syz + szy
+        sxypsyx = sxy + syx
+        syzmszy = syz - szy
+        sxzmszx = sxz - szx
+        sxymsyx = sxy - syx
+        sxxpsyy = sxx + syy
+        sxxmsyy = sxx - syy
+        sxy2sxz2syx2szx2 = sxy2 + sxz2 - syx2 - szx2
+
+        c0 = (
+            sxy2sxz2syx2szx2 * sxy2sxz2syx2szx2
+            + (sxx2syy2szz2syz2szy2 + syzszymsyyszz2) * (sxx2syy2szz2syz2szy2 - syzszymsyyszz2)
+            + (-sxzpszx * syzmszy + sxymsyx * (sxxmsyy - szz))
+            * (-sxzmszx * syzpszy + sxymsyx * (sxxmsyy + szz))
+            + (-sxzpszx * syzpszy - sxypsyx * (sxxpsyy - szz))
+            * (-sxzmszx * syzmszy - sxypsyx * (sxxpsyy + szz))
+            + (sxypsyx * syzpszy + sxzpszx * (sxxmsyy + szz))
+            * (-sxymsyx * syzmszy + sxzpszx * (sxxpsyy + szz))
+            + (sxypsyx * syzmszy + sxzmszx * (sxxmsyy - szz))
+            * (-sxymsyx * syzpszy + sxzmszx * (sxxpsyy - szz))
+        )
+
+        # e0 is an upper bound of the largest eigenvalue
+        eigenvalue = e0
+        slope = 0.0
+        degenerate = False
+        for _ in range(50):
+            previous = eigenvalue
+            x2 = eigenvalue * eigenvalue
+            b = (x2 + c2) * eigenvalue
+            a = b + c1
+            slope = 2.0 * x2 * eigenvalue + b + a
+            if slope == 0.0 or not np.isfinite(slope):
+                degenerate = True
+                break
+            eigenvalue -= (a * eigenvalue + c0) / slope
+            if abs(eigenvalue - previous) < abs(1e-11 * eigenvalue):
+                break
+        else:
+            # Not converged, Newton's method is slow close to a double root
+            degenerate = True
+
+        if degenerate or not slope > 1e-4 * eigenvalue * eigenvalue * eigenvalue:
+            # A (near) double root, e.g. for linear molecules, cannot be found
+            # precisely from the polynomial. Use the signed singular values.
+            S = np.linalg.svd(H)[1]
+            if np.linalg.det(H) < 0.0:
+                S[2] = -S[2]
+            eigenvalue = S.sum()
+
+        # Well above the cancellation error of e0 - eigenvalue
+        msd = 2.0 * (e0 - eigenvalue)
+        if msd > 1e-6 * e0:
+            return np.sqrt(msd / n)
+
+        # Close to zero the difference is lost to cancellation, so rotate P
+        # onto Q with the optimal rotation and sum the squared deviations
+        V, _, W = np.linalg.svd(H)
+        if np.linalg.det(V) * np.linalg.det(W) < 0.0:
+            V[:, 2] = -V[:, 2]
+        U = np.dot(V, W)
+
+        total = 0.0
+        for i in range(n):
+            for k in range(3):
+                diff = q_cent[k] - Q[i, k]
+                for j in range(3):
+                    diff += (P[i, j] - p_cent[j]) * U[j, k]
+                total += diff * diff
+
+        return np.sqrt(total / n)
+
+
+# Above this number of atoms the N! permutations of the brute force reorder
+# are replaced by the Hungarian method
+BRUTE_MAX_ATOMS = 8
+
+# Below this number of atoms the numba kernel beats the NumPy calls in
+# kabsch_rmsd, which are dominated by per call overhead
+FUSED_KABSCH_MAX_ATOMS = 200
+
+
+def _kabsch_rmsd_fused(P: ndarray, Q: ndarray, **kwargs: Any) -> float:
+    """
+    Calculate the Kabsch RMSD between P and Q with a single compiled numba
+    kernel. The RMSD is always computed about the centroids, so the translate
+    keyword is ignored. P and Q are not modified.
+    """
+    return float(
+        _kabsch_rmsd_kernel(
+            np.ascontiguousarray(P, dtype=np.float64),
+            np.ascontiguousarray(Q, dtype=np.float64),
+        )
+    )
 
-    reorder_method -> 'brute', 'hungarian'
-    reorder_method -> 'kabsch', 'quaternion'
 
+def _in_hungarian_order(atoms: ndarray, p_coord: ndarray, q_coord: ndarray) -> bool:
+    """
+    Check if the current order of two structures with identical atoms is
+    already an optimal Hungarian assignment, i.e. every atom in P is closest
+    to the atom of the same type and index in Q. The sum of row minima is a
+    lower bound on any assignment, so the identity is optimal if it reaches it.
+    """
+    # Squared distances have the same row minima
+    distances = _squared_distances(p_coord, q_coord)
+    distances[atoms[:, None] != atoms[None, :]] = np.inf
+    return bool((distances.diagonal() <= distances.min(axis=1)).all())
+
+
+def _get_atoms(atoms: Any) -> ndarray:
+    """
+    Get the atoms as a contiguous int32 array of atomic numbers. Element
+    symbols are converted with int_atom.
     """
+    atoms = np.asarray(atoms)
+    if atoms.dtype.kind in "US":
+        atoms = np.array([int_atom(str(atom)) for atom in atoms.astype(str)])
+    return np.ascontiguousarray(atoms, dtype=np.int32)
 
-    # Parse arguments
-    # settings = parse_arguments(args)
 
-    p_size = p_all.shape[0]
-    q_size = q_all.shape[0]
+def _check_atoms(p_atoms: ndarray, q_atoms: ndarray, reorder: bool) -> bool:
+    """
+    Check that P and Q are the same size and in the same order, unless they
+    are to be reordered. Returns True if the atoms are in the same order.
+    """
 
-    if not p_size == q_size:
+    if not p_atoms.shape[0] == q_atoms.shape[0]:
         raise ValueError("error: Structures not same size")
 
-    if np.count_nonzero(p_all_atoms != q_all_atoms) and not reorder:
+    same_order = np.array_equal(p_atoms, q_atoms)
+
+    if not same_order and not reorder:
         msg = """
 error: Atoms are not in the same order.
 
@@ -49,52 +269,55 @@ https://github.com/charnley/rmsd for further examples.
         print(msg)
         sys.exit()
 
-    # Typing
-    index: Union[Set[int], List[int], ndarray]
+    return same_order
 
-    # Set local view
-    p_view: Optional[ndarray] = None
-    q_view: Optional[ndarray] = None
 
-    # Set local view
-    if p_view is None:
-        p_coord = copy.deepcopy(p_all)
-        q_coord = copy.deepcopy(q_all)
-        p_atoms = copy.deepcopy(p_all_atoms)
-        q_atoms = copy.deepcopy(q_all_atoms)
-
-    else:
-        assert p_view is not None
-        assert q_view is not None
-        p_coord = copy.deepcopy(p_all[p_view])
-        q_coord = copy.deepcopy(q_all[q_view])
-        p_atoms = copy.deepcopy(p_all_atoms[p_view])
-        q_atoms = copy.deepcopy(q_all_atoms[q_view])
+def _get_methods(
+    rotation_method: str, reorder_method: str, n_atoms: int
+) -> Tuple[RmsdCallable, Optional[ReorderCallable]]:
+    """
+    Get the rmsd and reorder callables for the method names
+    """
+
+    rmsd_method = _ROT.get(rotation_method, rmsd)
+    reorder_function = _REORDER.get(reorder_method)
+
+    if reorder_function is reorder_brute and n_atoms > BRUTE_MAX_ATOMS:
+        warnings.warn(
+            f"Brute force reorder of {n_atoms} atoms is intractable, "
+            "using the Hungarian method instead"
+        )
+        reorder_function = reorder_hungarian
+
+    # Only the RMSD is needed, not the rotation
+    if rmsd_method is kabsch_rmsd:
+        if numba is not None and n_atoms <= FUSED_KABSCH_MAX_ATOMS:
+            rmsd_method = _kabsch_rmsd_fused
+        else:
+            rmsd_method = kabsch_rmsd_only
+
+    return rmsd_method, reorder_function
+
+
+def _get_rmsd_core(
+    p_atoms: ndarray,
+    p_coord: ndarray,
+    q_atoms: ndarray,
+    q_coord: ndarray,
+    same_order: bool,
+    reorder: bool,
+    reorder_method: Optional[ReorderCallable],
+    rmsd_method: RmsdCallable,
+    use_reflections: bool,
+    use_ref_stereo: bool,
+) -> float:
+    """
+    Calculate the RMSD between P, already centered, and Q. Q is centered in
+    place.
+    """
 
     # Recenter to centroid
-    p_cent = centroid(p_coord)
-    q_cent = centroid(q_coord)
-    p_coord -= p_cent
-    q_coord -= q_cent
-
-    # rmsd_method: RmsdCallable
-    # reorder_method: Optional[ReorderCallable]
-
-    # set rotation method
-    if rotation_method == 'kabsch':
-        rmsd_method = kabsch_rmsd
-    elif rotation_method == 'quaternion':
-        rmsd_method = quaternion_rmsd
-    else:
-        rmsd_method = rmsd
-
-    # set reorder method
-    # reorder_method = None # this is an artifact of them
-    # needing to pull from argparsed settings
-    if reorder_method == 'hungarian':
-        reorder_method = reorder_hungarian
-    elif reorder_method == 'brute':
-        reorder_method = reorder_brute  # pragma: no cover
+    _center_inplace(q_coord)
 
     # Save the resulting RMSD
     result_rmsd = None
@@ -130,17 +353,26 @@ https://github.com/charnley/rmsd for further examples.
         assert reorder_method is not None, \
                 "Cannot reorder without selecting --reorder method"
 
-        q_review = reorder_method(p_atoms, q_atoms, p_coord, q_coord)
+        if (
+            same_order
+            and reorder_method is reorder_hungarian
+            and _in_hungarian_order(p_atoms, p_coord, q_coord)
+        ):
+            # Atoms are already in an optimal order, no need to solve the assignment
+            pass
+
+        else:
+            q_review = reorder_method(p_atoms, q_atoms, p_coord, q_coord)
 
-    
     if q_review is not None:
-        q_all_atoms = q_all_atoms[q_review]
-        q_atoms = q_atoms[q_review]
-        q_coord = q_coord[q_review]
-        assert all(
-            p_atoms == q_atoms
-        ), "error: Structure not aligned. Please submit bug report at http://github.com/charnley/rmsd"
+        q_coord = np.take(q_coord, q_review, axis=0)
 
+        # Atoms are only needed to check the alignment, skipped with python -O
+        if __debug__:
+            q_atoms = np.take(q_atoms, q_review)
+            assert np.array_equal(
+                p_atoms, q_atoms
+            ), "error: Structure not aligned. Please submit bug report at http://github.com/charnley/rmsd"
 
     # We don't really care about the mapped orientations, so this whole block
     # I am just commenting out.
@@ -153,8 +385,6 @@ https://github.com/charnley/rmsd for further examples.
         # if q_reflection is not None:
             # q_coord = np.dot(q_coord, np.diag(q_reflection))
 
-        # q_coord -= centroid(q_coord)
-
         # # Rotate q coordinates
         # # TODO Should actually follow rotation method !Does this TODO matter?
         # q_coord = kabsch_rotate(q_coord, p_coord)
@@ -169,9 +399,116 @@ https://github.com/charnley/rmsd for further examples.
     if not result_rmsd:
         result_rmsd = rmsd_method(p_coord, q_coord)
 
+    return result_rmsd
+
+
+def get_rmsd(p_all_atoms, p_all, q_all_atoms, q_all, reorder = True,
+             reorder_method = 'hungarian', rotation_method = 'kabsch',
+             use_reflections = False, use_ref_stereo = False,
+             print_rmsd = True) -> float:
+
+    """
+
+    p/q_all_atoms -> list of atomic numbers or element symbols
+    p/q_all -> np.ndarray of coordinates (N,3)
+
+    reorder_method -> 'hungarian', 'inertia-hungarian', 'brute', 'distance', 'qml'
+    rotation_method -> 'kabsch', 'quaternion', 'none'
+
+    If p_all_atoms and q_all_atoms are identical and every atom is already
+    closest to its counterpart, the Hungarian reorder step is skipped.
+
+    """
+
+    # Set local view
+    p_coord = np.array(p_all, dtype=np.float64, copy=True, order="C")
+    q_coord = np.array(q_all, dtype=np.float64, copy=True, order="C")
+    p_atoms = _get_atoms(p_all_atoms)
+    q_atoms = _get_atoms(q_all_atoms)
+
+    same_order = _check_atoms(p_atoms, q_atoms, reorder)
+
+    # Recenter to centroid
+    _center_inplace(p_coord)
+
+    # set rotation and reorder method
+    rmsd_method, reorder_function = _get_methods(
+        rotation_method, reorder_method, p_coord.shape[0]
+    )
+
+    result_rmsd = _get_rmsd_core(
+        p_atoms,
+        p_coord,
+        q_atoms,
+        q_coord,
+        same_order,
+        reorder,
+        reorder_function,
+        rmsd_method,
+        use_reflections,
+        use_ref_stereo,
+    )
+
     # Probably want to return this to loop over structures.
     # print("{0}".format(result_rmsd))
     if print_rmsd:
         print(result_rmsd)
 
     return result_rmsd
+
+
+def get_rmsd_batch(p_all_atoms, p_all, q_all_atoms_batch, q_all_batch,
+                   reorder = True, reorder_method = 'hungarian',
+                   rotation_method = 'kabsch', use_reflections = False,
+                   use_ref_stereo = False) -> ndarray:
+
+    """
+
+    Calculate the RMSD between structure P and each structure in a batch of
+    Q structures, e.g. a set of conformers. P is only prepared once.
+
+    p_all_atoms -> list of atomic numbers or element symbols
+    p_all -> np.ndarray of coordinates (N,3)
+    q_all_atoms_batch -> list of atomic numbers per structure, or one list
+                         shared by all structures
+    q_all_batch -> list of np.ndarray of coordinates (N,3), or (B,N,3) array
+
+    Methods are the same as for get_rmsd. Returns np.ndarray of RMSDs (B).
+
+    """
+
+    p_coord = np.array(p_all, dtype=np.float64, copy=True, order="C")
+    p_atoms = _get_atoms(p_all_atoms)
+    _center_inplace(p_coord)
+
+    rmsd_method, reorder_function = _get_methods(
+        rotation_method, reorder_method, p_coord.shape[0]
+    )
+
+    shared_atoms = np.ndim(q_all_atoms_batch) == 1
+
+    result_rmsd = np.empty(len(q_all_batch))
+
+    for i, q_all in enumerate(q_all_batch):
+
+        q_all_atoms = q_all_atoms_batch if shared_atoms else q_all_atoms_batch[i]
+
+        q_coord = np.array(q_all, dtype=np.float64, copy=True, order="C")
+        q_atoms = _get_atoms(q_all_atoms)
+
+        same_order = _check_atoms(p_atoms, q_atoms, reorder)
+
+        result_rmsd[i] = _get_rmsd_core(
+            p_atoms,
+            p_coord,
+            q_atoms,
+            q_coord,
+            same_order,
+            reorder,
+            reorder_function,
+            rmsd_method,
+            use_reflections,
+            use_ref_stereo,
+        )
+
+    return result_rmsd
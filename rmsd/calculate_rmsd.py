@@ -12,22 +12,28 @@ __version__ = "1.5.1"
 import argparse
 import copy
 import gzip
+import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Iterator, List, Optional, Protocol, Set, Tuple, Union
+from typing import Any, Iterable, Iterator, List, Optional, Protocol, Set, Tuple, Union
 
 import numpy as np
 from numpy import ndarray
 from scipy.optimize import linear_sum_assignment  # type: ignore
 from scipy.spatial import distance_matrix  # type: ignore
-from scipy.spatial.distance import cdist  # type: ignore
 
 try:
     import qml  # type: ignore
 except ImportError:  # pragma: no cover
     qml = None  # pragma: no cover
 
+try:
+    from lap import lapjv  # type: ignore
+except ImportError:  # pragma: no cover
+    lapjv = None  # pragma: no cover
+
 
 METHOD_KABSCH = "kabsch"
 METHOD_QUATERNION = "quaternion"
@@ -50,6 +56,17 @@ REORDER_METHODS = [
     REORDER_DISTANCE,
 ]
 
+# Threads used to solve the Hungarian assignment for each atom type. Only
+# scipy releases the GIL, so threads are not used with lap.
+HUNGARIAN_THREADS = min(8, os.cpu_count() or 1)
+
+# Total size of the cost matrices, excluding the largest, above which the
+# threads are used. Below this, dispatching to the threads (~40 us) costs
+# more than solving the smaller assignments (~270 us for 100x100 in scipy).
+HUNGARIAN_PARALLEL_SIZE = 10000
+
+_HUNGARIAN_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
 
 AXIS_SWAPS = np.array([[0, 1, 2], [0, 2, 1], [1, 0, 2], [1, 2, 0], [2, 1, 0], [2, 0, 1]])
 
@@ -300,6 +317,10 @@ ELEMENT_NAMES = {
 
 NAMES_ELEMENT = {value: key for key, value in ELEMENT_NAMES.items()}
 
+# ELEMENT_WEIGHTS as an array indexed by atomic number
+_ELEMENT_WEIGHTS_ARRAY = np.full(max(ELEMENT_WEIGHTS) + 1, np.nan)
+_ELEMENT_WEIGHTS_ARRAY[list(ELEMENT_WEIGHTS)] = list(ELEMENT_WEIGHTS.values())
+
 
 class ReorderCallable(Protocol):
     def __call__(
@@ -368,6 +389,33 @@ def int_atom(atom: str) -> int:
     return NAMES_ELEMENT[atom]
 
 
+def atom_weights(atoms: ndarray) -> ndarray:
+    """
+    Get the atomic weights for a list of atoms
+
+    Parameters
+    ----------
+    atoms : array
+        (N) vector of atoms as integers
+
+    Returns
+    -------
+    weights : array
+        (N) vector of atomic weights
+    """
+    atoms = np.asarray(atoms)
+
+    if (atoms < 0).any() or (atoms >= len(_ELEMENT_WEIGHTS_ARRAY)).any():
+        raise KeyError(f"Unknown atomic number in {atoms}")
+
+    weights: ndarray = _ELEMENT_WEIGHTS_ARRAY[atoms]
+
+    if np.isnan(weights).any():
+        raise KeyError(f"Unknown atomic number in {atoms}")
+
+    return weights
+
+
 def rmsd(P: ndarray, Q: ndarray, **kwargs) -> float:
     """
     Calculate Root-mean-square deviation from two sets of vectors V and W.
@@ -427,6 +475,50 @@ def kabsch_rmsd(
     return rmsd(P, Q)
 
 
+def kabsch_rmsd_only(P: ndarray, Q: ndarray, translate: bool = False, **kwargs: Any) -> float:
+    """
+    Calculate the RMSD between P and Q after optimal rotation, without
+    constructing the rotation matrix. Only the singular values of the
+    covariance matrix are needed, with the smallest one negated if the
+    rotation would otherwise be a reflection. RMSDs close to zero are
+    calculated from the rotated coordinates, to avoid loss of precision.
+
+    Parameters
+    ----------
+    P : array
+        (N,D) matrix, where N is points and D is dimension.
+    Q : array
+        (N,D) matrix, where N is points and D is dimension.
+    translate : bool
+        Use centroids to translate vector P and Q unto each other.
+
+    Returns
+    -------
+    rmsd : float
+        root-mean squared deviation
+    """
+
+    if translate:
+        Q = Q - centroid(Q)
+        P = P - centroid(P)
+
+    C = np.dot(np.transpose(P), Q)
+    S = np.linalg.svd(C, compute_uv=False)
+
+    if np.linalg.det(C) < 0.0:
+        S[-1] = -S[-1]
+
+    norms = (P * P).sum() + (Q * Q).sum()
+    msd = norms - 2.0 * S.sum()
+
+    # Close to zero the difference is lost to cancellation, so fall back to
+    # rotating P onto Q
+    if not msd > 1e-6 * norms:
+        return float(rmsd(kabsch_rotate(P, Q), Q))
+
+    return float(np.sqrt(msd / P.shape[0]))
+
+
 def kabsch_rotate(P: ndarray, Q: ndarray) -> ndarray:
     """
     Rotate matrix P unto matrix Q using Kabsch algorithm.
@@ -823,7 +915,7 @@ def hungarian_vectors(
     # structure and trial structure
     indices_b: ndarray
     indices_a: ndarray
-    indices_a, indices_b = linear_sum_assignment(K)
+    indices_a, indices_b = _linear_sum_assignment(K)
 
     return indices_b
 
@@ -952,6 +1044,45 @@ def reorder_distance(
     return view_reorder
 
 
+def _squared_distances(A: ndarray, B: ndarray) -> ndarray:
+    """
+    Squared euclidean distance matrix between the rows of A and B, using
+    |a - b|^2 = |a|^2 + |b|^2 - 2 a.b so the work is a single matrix product
+    instead of the element-wise loop in cdist.
+    """
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    distances: ndarray = np.dot(A, B.T)
+    distances *= -2.0
+    distances += (A * A).sum(axis=1)[:, np.newaxis]
+    distances += (B * B).sum(axis=1)[np.newaxis, :]
+    return np.maximum(distances, 0.0, out=distances)
+
+
+def _linear_sum_assignment(cost: ndarray) -> Tuple[ndarray, ndarray]:
+    """
+    Solve the linear assignment problem for the cost matrix. If lap is
+    installed, square problems are solved with its faster Jonker-Volgenant
+    solver, otherwise scipy is used. With equal costs, the two solvers can
+    return different, but equally optimal, assignments.
+    """
+    if lapjv is None or cost.shape[0] != cost.shape[1] or cost.size == 0:
+        return linear_sum_assignment(cost)
+
+    _, indices_b, _ = lapjv(np.ascontiguousarray(cost, dtype=np.float64))
+    return np.arange(cost.shape[0]), indices_b
+
+
+def _get_hungarian_executor() -> ThreadPoolExecutor:
+    """
+    Get the thread pool for the Hungarian assignments, created on first use
+    """
+    global _HUNGARIAN_EXECUTOR
+    if _HUNGARIAN_EXECUTOR is None:
+        _HUNGARIAN_EXECUTOR = ThreadPoolExecutor(max_workers=HUNGARIAN_THREADS)
+    return _HUNGARIAN_EXECUTOR
+
+
 def hungarian(A: ndarray, B: ndarray) -> ndarray:
     """
     Hungarian reordering.
@@ -960,13 +1091,13 @@ def hungarian(A: ndarray, B: ndarray) -> ndarray:
     """
 
     # should be kabasch here i think
-    distances = cdist(A, B, "euclidean")
+    distances = np.sqrt(_squared_distances(A, B))
 
     # Perform Hungarian analysis on distance matrix between atoms of 1st
     # structure and trial structure
     indices_b: ndarray
     indices_a: ndarray
-    indices_a, indices_b = linear_sum_assignment(distances)
+    indices_a, indices_b = _linear_sum_assignment(distances)
 
     return indices_b
 
@@ -1008,14 +1139,29 @@ def reorder_hungarian(
     view_reorder = np.zeros(q_atoms.shape, dtype=int)
     view_reorder -= 1
 
+    atom_idx = []
+    blocks = []
     for atom in unique_atoms:
         (p_atom_idx,) = np.where(p_atoms == atom)
         (q_atom_idx,) = np.where(q_atoms == atom)
+        distances = _squared_distances(p_coord[p_atom_idx], q_coord[q_atom_idx])
+        blocks.append(np.sqrt(distances, out=distances))
+        atom_idx.append((p_atom_idx, q_atom_idx))
+
+    # The assignments per atom type are independent, and scipy releases the
+    # GIL, so solve them in threads if there is enough work besides the largest
+    sizes = [block.size for block in blocks]
+    views: Iterable[Tuple[ndarray, ndarray]]
+    if (
+        lapjv is None
+        and HUNGARIAN_THREADS > 1
+        and sum(sizes) - max(sizes, default=0) > HUNGARIAN_PARALLEL_SIZE
+    ):
+        views = list(_get_hungarian_executor().map(_linear_sum_assignment, blocks))
+    else:
+        views = map(_linear_sum_assignment, blocks)
 
-        A_coord = p_coord[p_atom_idx]
-        B_coord = q_coord[q_atom_idx]
-
-        view = hungarian(A_coord, B_coord)
+    for (p_atom_idx, q_atom_idx), (_, view) in zip(atom_idx, views):
         view_reorder[p_atom_idx] = q_atom_idx[view]
 
     return view_reorder
@@ -1324,8 +1470,7 @@ def get_cm(atoms: ndarray, V: ndarray) -> ndarray:
         The CM vector
     """
 
-    weights: Union[List[float], ndarray] = [ELEMENT_WEIGHTS[x] for x in atoms]
-    weights = np.asarray(weights)
+    weights = atom_weights(atoms)
     center_of_mass: ndarray = np.average(V, axis=0, weights=weights)
 
     return center_of_mass
@@ -1347,22 +1492,18 @@ def get_inertia_tensor(atoms: ndarray, V: ndarray) -> ndarray:
     """
 
     CV = V - get_cm(atoms, V)
+    weights = atom_weights(atoms)
 
-    Ixx = 0.0
-    Iyy = 0.0
-    Izz = 0.0
-    Ixy = 0.0
-    Ixz = 0.0
-    Iyz = 0.0
-
-    for sp, acoord in zip(atoms, CV):
-        amass = ELEMENT_WEIGHTS[sp]
-        Ixx += amass * (acoord[1] * acoord[1] + acoord[2] * acoord[2])
-        Iyy += amass * (acoord[0] * acoord[0] + acoord[2] * acoord[2])
-        Izz += amass * (acoord[0] * acoord[0] + acoord[1] * acoord[1])
-        Ixy += -amass * acoord[0] * acoord[1]
-        Ixz += -amass * acoord[0] * acoord[2]
-        Iyz += -amass * acoord[1] * acoord[2]
+    X = CV[:, 0]
+    Y = CV[:, 1]
+    Z = CV[:, 2]
+
+    Ixx = (weights * (Y * Y + Z * Z)).sum()
+    Iyy = (weights * (X * X + Z * Z)).sum()
+    Izz = (weights * (X * X + Y * Y)).sum()
+    Ixy = -(weights * X * Y).sum()
+    Ixz = -(weights * X * Z).sum()
+    Iyz = -(weights * Y * Z).sum()
 
     return np.array([[Ixx, Ixy, Ixz], [Ixy, Iyy, Iyz], [Ixz, Iyz, Izz]])
 
@@ -2021,24 +2162,28 @@ https://github.com/charnley/rmsd for further examples.
     # If there is a reorder, then apply before print
     if q_review is not None:
 
-        q_all_atoms = q_all_atoms[q_review]
-        q_atoms = q_atoms[q_review]
-        q_coord = q_coord[q_review]
+        q_coord = np.take(q_coord, q_review, axis=0)
 
-        assert all(
-            p_atoms == q_atoms
-        ), "error: Structure not aligned. Please submit bug report at http://github.com/charnley/rmsd"
+        if __debug__:
+            q_atoms = np.take(q_atoms, q_review)
+            assert np.array_equal(
+                p_atoms, q_atoms
+            ), "error: Structure not aligned. Please submit bug report at http://github.com/charnley/rmsd"
 
     # print result
     if settings.output:
 
+        if q_review is not None:
+            q_all_atoms = np.take(q_all_atoms, q_review)
+
         if q_swap is not None:
             q_coord = q_coord[:, q_swap]
 
         if q_reflection is not None:
             q_coord = np.dot(q_coord, np.diag(q_reflection))
 
-        q_coord -= centroid(q_coord)
+        # q_coord is still centered, as atom reorder, axis swaps and axis
+        # reflections all keep the centroid at the origin
 
         # Rotate q coordinates
         # TODO Should actually follow rotation method
@@ -1,4 +1,6 @@
 import ase.io
+import numpy as np
+import pytest
 # from calc_rmsd_pythonbindings import get_rmsd
 from rmsd import *
 from context import RESOURCE_PATH
@@ -85,5 +87,181 @@ def test_base_package():
             "Package doesn't correctly detect identical molecule"
 
 
+def test_reorder_brute():
+    base = ase.io.read(RESOURCE_PATH / "base.xyz")
+    shuf = ase.io.read(RESOURCE_PATH / "shuffled_then_rot_trans.xyz")
 
-    
+    r = get_rmsd(base.get_atomic_numbers(), base.positions,
+                 shuf.get_atomic_numbers(), shuf.positions,
+                 rotation_method = "kabsch",
+                 reorder_method = "brute",
+                 reorder = True,
+                 print_rmsd = False)
+
+    assert r < 1e-6 , \
+            "Brute reorder doesn't detect identical molecule"
+
+
+def test_batch():
+    base = ase.io.read(RESOURCE_PATH / "base.xyz")
+    others = [
+        ase.io.read(RESOURCE_PATH / filename)
+        for filename in ["shuffled_then_rot_trans.xyz", "rattled.xyz", "rattled_shuffled.xyz"]
+    ]
+
+    r = get_rmsd_batch(base.get_atomic_numbers(), base.positions,
+                       [o.get_atomic_numbers() for o in others],
+                       [o.positions for o in others],
+                       rotation_method = "kabsch",
+                       reorder_method = "hungarian",
+                       reorder = True)
+
+    for o, r_batch in zip(others, r):
+        r_single = get_rmsd(base.get_atomic_numbers(), base.positions,
+                            o.get_atomic_numbers(), o.positions,
+                            rotation_method = "kabsch",
+                            reorder_method = "hungarian",
+                            reorder = True,
+                            print_rmsd = False)
+
+        assert abs(r_batch - r_single) < 1e-10 , \
+                "Batch RMSD doesn't match single RMSD"
+
+
+def test_reorder_brute_large():
+    # Brute force is replaced by the Hungarian method above BRUTE_MAX_ATOMS
+    mol_a = ase.io.read(RESOURCE_PATH / "CHEMBL3039407.xyz")
+    mol_b = ase.io.read(RESOURCE_PATH / "CHEMBL3039407_order.xyz")
+
+    with pytest.warns(UserWarning):
+        r_brute = get_rmsd(mol_a.get_atomic_numbers(), mol_a.positions,
+                           mol_b.get_atomic_numbers(), mol_b.positions,
+                           reorder_method = "brute",
+                           print_rmsd = False)
+
+    r_hungarian = get_rmsd(mol_a.get_atomic_numbers(), mol_a.positions,
+                           mol_b.get_atomic_numbers(), mol_b.positions,
+                           reorder_method = "hungarian",
+                           print_rmsd = False)
+
+    assert r_brute == r_hungarian
+
+
+def check_kabsch_kernel(atoms, p_coord, q_coord):
+    # Compare the fused numba kernel and get_rmsd to kabsch_rmsd
+    reference = kabsch_rmsd(p_coord, q_coord, translate=True)
+
+    r = get_rmsd(atoms, p_coord, atoms, q_coord, reorder = False,
+                 print_rmsd = False)
+    assert abs(r - reference) < 1e-10 , \
+            "get_rmsd doesn't match kabsch_rmsd"
+
+    pytest.importorskip("numba")
+    from rmsd.calc_rmsd_pythonbindings import _kabsch_rmsd_fused
+
+    r = _kabsch_rmsd_fused(p_coord, q_coord)
+    assert abs(r - reference) < 1e-10 , \
+            "Fused Kabsch kernel doesn't match kabsch_rmsd"
+
+
+def test_kabsch_kernel_single_atom():
+    p_coord = np.array([[0.0, 0.0, 0.0]])
+    q_coord = np.array([[1.0, 2.0, 3.0]])
+    check_kabsch_kernel([1], p_coord, q_coord)
+
+
+def test_kabsch_kernel_diatomic():
+    for axis in range(3):
+        p_coord = np.zeros((2, 3))
+        p_coord[1, axis] = 0.74
+        check_kabsch_kernel([1, 1], p_coord, p_coord + [3.0, 0.0, 0.0])
+
+
+def test_kabsch_kernel_linear():
+    p_coord = np.array([[0.0, 0.0, -1.16], [0.0, 0.0, 0.0], [0.0, 0.0, 1.16]])
+    q_coord = np.array([[-1.0, 0.5, 0.0], [0.1, 0.5, 0.0], [1.3, 0.5, 0.0]])
+    check_kabsch_kernel([8, 6, 8], p_coord, q_coord)
+    check_kabsch_kernel([8, 6, 8], p_coord, p_coord + 1.0)
+
+
+def test_kabsch_kernel_mirrored():
+    base = ase.io.read(RESOURCE_PATH / "base.xyz")
+    p_coord = base.positions
+    q_coord = p_coord * np.array([1.0, 1.0, -1.0])
+    check_kabsch_kernel(base.get_atomic_numbers(), p_coord, q_coord)
+
+
+def check_rotated_copy(n_atoms):
+    # Exactly rotated and translated copy of a large random structure
+    np.random.seed(1)
+    atoms = np.ones(n_atoms, dtype=int)
+    p_coord = np.random.uniform(-40.0, 40.0, size=(n_atoms, 3))
+    rotation, _ = np.linalg.qr(np.random.normal(size=(3, 3)))
+    rotation *= np.linalg.det(rotation)
+    q_coord = np.dot(p_coord, rotation) + [1.0, -2.0, 3.0]
+
+    r = get_rmsd(atoms, p_coord, atoms, q_coord, reorder = False,
+                 print_rmsd = False)
+
+    assert r < 1e-10 , \
+            "Doesn't detect identical molecule rotated and translated"
+
+
+def test_rotated_copy_fused():
+    check_rotated_copy(200)
+
+
+def test_rotated_copy_large():
+    check_rotated_copy(1000)
+
+
+def test_element_symbols():
+    atoms, p_coord = get_coordinates(RESOURCE_PATH / "ethane.xyz", "xyz")
+    q_coord = p_coord[::-1] + 1.0
+
+    r = get_rmsd(atoms, p_coord, atoms[::-1], q_coord, print_rmsd = False)
+
+    assert r < 1e-6 , \
+            "Doesn't accept atoms as element symbols"
+
+
+def test_element_symbols_inertia():
+    atoms, p_coord = get_coordinates(RESOURCE_PATH / "ethane.xyz", "xyz")
+    q_coord = p_coord[::-1] + 1.0
+
+    r = get_rmsd(atoms, p_coord, atoms[::-1], q_coord,
+                 reorder_method = "inertia-hungarian", print_rmsd = False)
+
+    assert r < 1e-6 , \
+            "Doesn't accept element symbols with inertia-hungarian"
+
+
+def test_kabsch_kernel_linear_noisy():
+    # Linear P gives a double root, where Newton's method may not converge
+    p_coord = np.array(
+        [
+            [0.00635536773480902, 0.03018815193238667, 0.48059250433491524],
+            [-0.00529947161784979, -0.02517261959285006, -0.40074570705400303],
+            [0.00909036771907443, 0.04317946864374933, 0.6874130293841345],
+            [0.00932244224461852, 0.04428182830712325, 0.7049624902615423],
+            [0.00841329804459846, 0.03996337115659011, 0.6362130636160783],
+        ]
+    )
+    q_coord = np.array(
+        [
+            [-0.04132689430038081, 0.10769381198767781, 0.4742801864802634],
+            [-0.01142028176691696, -0.0799962514819179, -0.4596607504179783],
+            [-0.03599311826340631, 0.02638907659600214, 0.6659963206715364],
+            [0.04183686664806617, 0.06311949712245662, 0.6693702439269971],
+            [0.01341019269926458, -0.02355990127391172, 0.5951757752339005],
+        ]
+    )
+    check_kabsch_kernel(np.ones(5, dtype=int), p_coord, q_coord)
+
+    np.random.seed(3)
+    for n_atoms in [30, 56]:
+        p_coord = np.zeros((n_atoms, 3))
+        p_coord[:, 0] = np.linspace(-10.0, 10.0, n_atoms)
+        for _ in range(50):
+            q_coord = p_coord + np.random.normal(scale=0.1, size=(n_atoms, 3))
+            check_kabsch_kernel(np.ones(n_atoms, dtype=int), p_coord, q_coord)
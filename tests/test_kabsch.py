@@ -41,3 +41,23 @@ def test_kabash_rotate_pdb() -> None:
     new_p_coord = rmsdlib.kabsch_rotate(p_coord, q_coord)
 
     np.testing.assert_array_almost_equal([10.6822, -2.8867, 12.6977], new_p_coord[0], decimal=3)
+
+
+def test_kabash_rmsd_only() -> None:
+
+    filename_1 = RESOURCE_PATH / "ci2_1.pdb"
+    filename_2 = RESOURCE_PATH / "ci2_2.pdb"
+
+    _, p_coord = rmsdlib.get_coordinates(filename_1, "pdb")
+    _, q_coord = rmsdlib.get_coordinates(filename_2, "pdb")
+
+    value = rmsdlib.kabsch_rmsd_only(p_coord, q_coord, translate=True)
+
+    np.testing.assert_almost_equal(value, 11.7768, decimal=4)
+
+    # Mirrored structure must not be reflected back
+    q_mirror = q_coord * np.array([1.0, 1.0, -1.0])
+    value = rmsdlib.kabsch_rmsd_only(q_mirror, q_coord, translate=True)
+    reference = rmsdlib.kabsch_rmsd(q_mirror, q_coord, translate=True)
+
+    np.testing.assert_almost_equal(value, reference, decimal=8)
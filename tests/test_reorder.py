@@ -1,4 +1,5 @@
 import copy
+import sys
 
 import numpy as np
 
@@ -129,3 +130,37 @@ def test_reorder_inertia_hungarian() -> None:
     result_rmsd = rmsdlib.kabsch_rmsd(p_coord, q_coord[review])
 
     np.testing.assert_almost_equal(0, result_rmsd, decimal=2)
+
+
+def test_reorder_hungarian_threads(monkeypatch) -> None:
+
+    calculate_rmsd = sys.modules["rmsd.calculate_rmsd"]
+
+    np.random.seed(6)
+    N = 300
+    atoms = np.random.choice([1, 6, 7, 8], size=N)
+    p_coord = np.random.normal(size=(N, 3))
+    idx = np.random.permutation(N)
+    q_atoms = atoms[idx]
+    q_coord = p_coord[idx] + np.random.normal(scale=0.05, size=(N, 3))
+
+    # Serial
+    monkeypatch.setattr(calculate_rmsd, "HUNGARIAN_PARALLEL_SIZE", N * N)
+    view_serial = rmsdlib.reorder_hungarian(atoms, q_atoms, p_coord, q_coord)
+
+    # Threaded, with the scipy solver
+    monkeypatch.setattr(calculate_rmsd, "HUNGARIAN_PARALLEL_SIZE", 0)
+    monkeypatch.setattr(calculate_rmsd, "HUNGARIAN_THREADS", 2)
+    monkeypatch.setattr(calculate_rmsd, "lapjv", None)
+    monkeypatch.setattr(calculate_rmsd, "_HUNGARIAN_EXECUTOR", None)
+    view_threads = rmsdlib.reorder_hungarian(atoms, q_atoms, p_coord, q_coord)
+
+    assert calculate_rmsd._HUNGARIAN_EXECUTOR is not None
+    calculate_rmsd._HUNGARIAN_EXECUTOR.shutdown()
+
+    # The serial run may use lap, so compare the assignment cost
+    cost_serial = np.linalg.norm(p_coord - q_coord[view_serial], axis=1).sum()
+    cost_threads = np.linalg.norm(p_coord - q_coord[view_threads], axis=1).sum()
+
+    assert atoms.tolist() == q_atoms[view_threads].tolist()
+    np.testing.assert_almost_equal(cost_serial, cost_threads)
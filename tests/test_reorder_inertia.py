@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 
 import rmsd as rmsdlib
 
@@ -55,3 +56,16 @@ def test_reorder_inertia_hungarian() -> None:
     result_rmsd = rmsdlib.kabsch_rmsd(p_coord, q_coord[review])
 
     np.testing.assert_almost_equal(0, result_rmsd, decimal=2)
+
+
+def test_atom_weights() -> None:
+
+    atoms = np.array([1, 6, 8, 6])
+    weights = rmsdlib.atom_weights(atoms)
+    expected = [rmsdlib.ELEMENT_WEIGHTS[atom] for atom in atoms]
+
+    np.testing.assert_array_equal(weights, expected)
+
+    for unknown in [0, -1, 200]:
+        with pytest.raises(KeyError):
+            rmsdlib.atom_weights(np.array([1, unknown]))